@@ -4,27 +4,84 @@ import logging
 import asyncio
 import sys
 import time
-import threading
-from typing import Dict, Optional, Set, Tuple
-import re
-
+import functools
+import contextlib
+import html
+import array
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Set, Tuple
+
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from pyrogram import Client, filters
-from pyrogram.types import ChatJoinRequest, InlineKeyboardMarkup, InlineKeyboardButton, Message, Chat
-from pyrogram.errors import FloodWait, PeerIdInvalid, UserIsBlocked, UserNotParticipant, RPCError
+from pyrogram.enums import ChatMemberStatus, ChatType, MessageEntityType, ParseMode
+from pyrogram.types import Chat, ChatJoinRequest, InlineKeyboardMarkup, InlineKeyboardButton, Message, MessageEntity, User
+from pyrogram.errors import ChannelPrivate, ChatAdminRequired, FloodWait, InputUserDeactivated, PeerIdInvalid, UserIsBlocked, UserNotParticipant, RPCError
 from fastapi import FastAPI
-import uvicorn
+from fastapi.responses import ORJSONResponse
+
+if sys.platform != "win32":  # uvloop has no Windows build
+    import uvloop
+else:
+    uvloop = None
 
 # ---------------- Logging Setup ---------------- #
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+# Handlers only put records on a queue; a listener thread does the actual
+# stderr writes so the event loop never blocks on log I/O.
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+_LOG_QUEUE: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+LOG_LISTENER = QueueListener(_LOG_QUEUE, _log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_LOG_QUEUE)])
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
 log = logging.getLogger("UltraAutoApprover")
 
+
+def drain_logs() -> None:
+    """Blocks until every queued log record has been written."""
+    LOG_LISTENER.stop()  # the listener thread handles the queue up to its sentinel
+    LOG_LISTENER.start()
+
+# ---------------- Event Loop ---------------- #
+# Must be installed before the Pyrogram Client is created: the client grabs
+# the current event loop in its constructor.
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 # ---------------- In-Memory Storage ---------------- #
 USER_DATABASE: Set[int] = set()
-PENDING_REQUESTS: Dict[Tuple[int, int], float] = {}  # (chat_id, user_id) -> timestamp
+# Chats where the bot has approved a join request, i.e. the ones the cleaner checks.
+# Dropped again when the cleaner hits a permission/peer error there.
+ADMIN_CHATS: Set[int] = set()
+# (chat_id, user_id) -> time.monotonic_ns() when approval started (kept if it failed).
+# Bounded so failed approvals can't grow it forever; entries expire after an hour.
+PENDING_REQUESTS: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+ADMIN_CACHE_TTL = 60  # seconds
+_ADMIN_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=ADMIN_CACHE_TTL)  # (chat_id, user_id) -> is_admin
+# Users whose welcome PM failed with a block/peer error; they get the chat
+# fallback directly until they /start the bot again
+BLOCKED_USERS: Set[int] = set()
+# (chat_id, user_id) pairs welcomed recently; repeat joiners get no second PM
+WELCOME_COOLDOWN = 3600  # seconds
+_WELCOMED: TTLCache = TTLCache(maxsize=50_000, ttl=WELCOME_COOLDOWN)
+DUPLICATE_REQUEST_WINDOW = 5  # seconds; repeat updates for the same request are ignored
+_DUPLICATE_REQUEST_WINDOW_NS = DUPLICATE_REQUEST_WINDOW * 1_000_000_000
+
+# Join requests waiting for a worker (see join_request_worker)
+JOIN_QUEUE_SIZE = 1000
+JOIN_BATCH_SIZE = 50
+JOIN_REQUEST_WORKERS = 4
+_JOIN_QUEUE: "asyncio.Queue[ChatJoinRequest]" = asyncio.Queue(maxsize=JOIN_QUEUE_SIZE)
+_JOIN_WORKER_TASKS: List[asyncio.Task] = []
+
+# Welcome PMs waiting for a sender (see welcome_worker)
+WELCOME_QUEUE_SIZE = 10_000
+WELCOME_WORKERS = 8
+_WELCOME_QUEUE: "asyncio.Queue[Tuple[User, Chat]]" = asyncio.Queue(maxsize=WELCOME_QUEUE_SIZE)
+_WELCOME_WORKER_TASKS: List[asyncio.Task] = []
 
 # ---------------- Load environment ---------------- #
 load_dotenv()
@@ -41,66 +98,329 @@ try:
     DEVELOPER_ID_ENV = os.getenv("DEVELOPER_ID")
     DEVELOPER_ID: Optional[int] = int(DEVELOPER_ID_ENV) if DEVELOPER_ID_ENV and DEVELOPER_ID_ENV.strip() else None
 
-    MANDATORY_CHANNEL = os.getenv("MANDATORY_CHANNEL", "@narzoxbot")
+    MANDATORY_CHANNEL = sys.intern(os.getenv("MANDATORY_CHANNEL", "@narzoxbot"))
     RULES_LINK = os.getenv("RULES_LINK", "https://t.me/teamrajweb")
     SUPPORT_LINK = os.getenv("SUPPORT_LINK", "https://t.me/narzoxbot")
 
     WEB_PORT = int(os.getenv("PORT", 8080))
 
+    # e.g. WARNING in production; setLevel raises ValueError on an unknown name
+    logging.getLogger().setLevel(os.getenv("LOG_LEVEL", "INFO").strip().upper())
+
+    # Binary file (int64 per user) that keeps USER_DATABASE across restarts
+    USERS_FILE = os.getenv("USERS_FILE", "users.bin")
+    # Same format, for ADMIN_CHATS
+    CHATS_FILE = os.getenv("CHATS_FILE", "chats.bin")
+
+    # Optional: comma-separated CPU ids to pin the process to, e.g. "0,1"
+    CPU_AFFINITY_ENV = os.getenv("CPU_AFFINITY", "")
+    CPU_AFFINITY: Set[int] = {int(c) for c in CPU_AFFINITY_ENV.split(",") if c.strip()}
+
+    # Update-dispatch tasks in Pyrogram; its default is min(32, cpu_count + 4)
+    PYROGRAM_WORKERS = int(os.getenv("PYROGRAM_WORKERS", 32))
+
     if not API_ID or not API_HASH or not BOT_TOKEN:
         log.error("❌ Missing required env vars: API_ID / API_HASH / BOT_TOKEN are required.")
         sys.exit(1)
 
 except Exception as e:
-    log.error(f"❌ Error while reading environment variables: {e}")
+    log.error("❌ Error while reading environment variables: %s", e)
     sys.exit(1)
 
-CHANNEL_LINK = f"https://t.me/{MANDATORY_CHANNEL.strip('@')}"
+logging.getLogger("pyrogram").setLevel(logging.WARNING)
+
+_CHANNEL_HANDLE = sys.intern(MANDATORY_CHANNEL.strip("@"))
+CHANNEL_LINK = f"https://t.me/{_CHANNEL_HANDLE}"
 BOT_USERNAME: Optional[str] = None
 
+CLEANER_APPROVE_CONCURRENCY = 5  # parallel approvals per chat
+CLEANER_CHAT_CONCURRENCY = 8  # chats cleaned in parallel
+CHAT_DROP_STRIKES = 3  # consecutive permission/peer failures before a chat leaves ADMIN_CHATS
+_CHAT_ERROR_STRIKES: Dict[int, int] = {}
+
+USERS_FLUSH_INTERVAL = 10  # seconds between appends of new users to USERS_FILE
+
+# Attempts per call when Telegram answers with FloodWait
+FLOOD_WAIT_RETRIES = 3
+
+# Broadcast tuning: sends in flight at once / users handled per batch
+BROADCAST_CONCURRENCY = 20
+BROADCAST_CHUNK = 500
+BROADCAST_PROGRESS_INTERVAL = 5  # seconds between progress edits of the status message
+
 # ---------------- Pyrogram Client ---------------- #
 app = Client(
     "auto_approver_session",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN,
+    # Sleep through FloodWaits while signing in (ImportBotAuthorization often
+    # gets a short one on restart); main() lowers it to 0 once started
     sleep_threshold=60,
+    workers=PYROGRAM_WORKERS,
     in_memory=True
 )
 
-app._cleaner_task_started = False
+CLEANER_TASK: Optional[asyncio.Task] = None
 
 
 # ---------------- FastAPI Health-check ---------------- #
-web_app = FastAPI()
+@contextlib.asynccontextmanager
+async def web_lifespan(_: FastAPI):
+    yield
+    # uvicorn runs this inside serve(), before it re-raises SIGTERM/SIGINT with
+    # the default handler restored, so it is the last point where shutdown
+    # work is guaranteed to run.
+    await shutdown()
+
+
+web_app = FastAPI(default_response_class=ORJSONResponse, lifespan=web_lifespan)
+
+
+_HEALTH_AUTO_APPROVE = AUTO_APPROVE_CHAT_ID or "ALL (Using Safe Dialog Check)"
 
 
 @web_app.get("/")
-def home():
+async def home():
     """Health check for external pinger services (like UptimeRobot)."""
-    return {
+    # Returning the Response directly skips FastAPI's jsonable_encoder pass
+    return ORJSONResponse({
         "status": "✅ Bot is Running (via FastAPI)",
-        "auto_approve_chat_id": AUTO_APPROVE_CHAT_ID or "ALL (Using Safe Dialog Check)",
+        "auto_approve_chat_id": _HEALTH_AUTO_APPROVE,
         "users_tracked": len(USER_DATABASE),
-        "cleaner_task_active": app._cleaner_task_started
-    }
+        "cleaner_task_active": cleaner_active()
+    })
+
+
+# ---------------- User Persistence ---------------- #
+_UNSAVED_USERS = array.array("q")  # tracked users not yet appended to USERS_FILE
+_UNSAVED_CHATS = array.array("q")  # tracked chats not yet appended to CHATS_FILE
+_FLUSH_TASK: Optional[asyncio.Task] = None
+
+
+def load_ids(path: str) -> Set[int]:
+    """Reads an int64 id file (USERS_FILE / CHATS_FILE)."""
+    arr = array.array("q")
+    try:
+        with open(path, "rb") as f:
+            arr.fromfile(f, os.path.getsize(path) // arr.itemsize)
+    except FileNotFoundError:
+        pass
+    return set(arr)
+
+
+def track_user(user_id: int) -> None:
+    """Adds a user to USER_DATABASE and queues it for the next flush."""
+    if user_id not in USER_DATABASE:
+        USER_DATABASE.add(user_id)
+        _UNSAVED_USERS.append(user_id)
+
+
+def track_chat(chat_id: int) -> None:
+    """Adds a chat to ADMIN_CHATS and queues it for the next flush."""
+    if chat_id not in ADMIN_CHATS:
+        ADMIN_CHATS.add(chat_id)
+        _UNSAVED_CHATS.append(chat_id)
+
+
+def _append_ids(path: str, ids: array.array) -> None:
+    if not ids:
+        return
+    try:
+        with open(path, "ab") as f:
+            # A write that failed part-way (e.g. disk full) may have left a partial
+            # int64 record; cut it off so this append stays 8-byte aligned.
+            # Whole records written before the failure just repeat, which is harmless.
+            end = f.tell()
+            if end % ids.itemsize:
+                f.truncate(end - end % ids.itemsize)
+            ids.tofile(f)
+        del ids[:]
+    except OSError as e:
+        log.error("❌ Could not save ids to %s: %s", path, e)
+
+
+def flush_users() -> None:
+    """Appends newly tracked users and chats to USERS_FILE / CHATS_FILE."""
+    _append_ids(USERS_FILE, _UNSAVED_USERS)
+    _append_ids(CHATS_FILE, _UNSAVED_CHATS)
+
+
+def _rewrite_ids(path: str, ids: Set[int], unsaved: array.array) -> None:
+    """Atomically replaces `path` with `ids`; the pending `unsaved` buffer is then redundant."""
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            array.array("q", ids).tofile(f)
+        os.replace(tmp_path, path)
+        del unsaved[:]
+    except OSError as e:
+        log.error("❌ Could not rewrite %s: %s", path, e)
+
+
+def save_users() -> None:
+    """Rewrites USERS_FILE from USER_DATABASE (needed after users are removed)."""
+    _rewrite_ids(USERS_FILE, USER_DATABASE, _UNSAVED_USERS)
+
+
+def untrack_chat(chat_id: int) -> None:
+    """Drops a chat the bot can no longer manage from ADMIN_CHATS and CHATS_FILE."""
+    if chat_id in ADMIN_CHATS:
+        ADMIN_CHATS.discard(chat_id)
+        _rewrite_ids(CHATS_FILE, ADMIN_CHATS, _UNSAVED_CHATS)
+
+
+async def users_flusher():
+    """Background task that periodically persists newly tracked users."""
+    while True:
+        await asyncio.sleep(USERS_FLUSH_INTERVAL)
+        flush_users()
+
+
+# ---------------- Rate Limiting ---------------- #
+class TokenBucket:
+    """
+    Adaptive token bucket (AIMD) for Telegram RPCs.
+
+    Use as `async with bucket:` around a call. A clean exit nudges the rate
+    up by `increase` (up to `max_rate`); a FloodWait cuts it by `backoff`
+    (down to `min_rate`) and empties the bucket.
+    """
+
+    def __init__(self, rate: float, max_rate: float, min_rate: float = 1.0,
+                 increase: float = 0.5, backoff: float = 0.5):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.backoff = backoff
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def __aenter__(self) -> "TokenBucket":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if exc is None:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+        elif isinstance(exc, FloodWait):
+            self.rate = max(self.min_rate, self.rate * self.backoff)
+            self._tokens = 0
+        return False
+
+
+# Outgoing messages (PMs, broadcast copies) share the bot-wide send limit
+MESSAGE_BUCKET = TokenBucket(rate=20, max_rate=30)
+_APPROVE_BUCKETS: Dict[int, TokenBucket] = {}
+
+
+def approve_bucket(chat_id: int) -> TokenBucket:
+    """Join-request approvals are limited per chat, so each chat gets its own bucket."""
+    bucket = _APPROVE_BUCKETS.get(chat_id)
+    if bucket is None:
+        bucket = _APPROVE_BUCKETS[chat_id] = TokenBucket(rate=5, max_rate=20)
+    return bucket
+
+
+async def call_with_flood_retry(bucket: TokenBucket, func, *args, **kwargs) -> bool:
+    """
+    Awaits func(*args, **kwargs) inside `bucket`, sleeping through FloodWait up
+    to FLOOD_WAIT_RETRIES times. Returns False if every attempt hit FloodWait.
+    """
+    for attempt in range(1, FLOOD_WAIT_RETRIES + 1):
+        try:
+            async with bucket:
+                await func(*args, **kwargs)
+            return True
+        except FloodWait as fw:
+            name = getattr(func, "__name__", func)
+            if attempt == FLOOD_WAIT_RETRIES:
+                log.warning("⏳ FloodWait on %s (%ss); giving up after %s attempts", name, fw.value, attempt)
+                break
+            log.warning("⏳ FloodWait on %s: sleeping %ss", name, fw.value)
+            await asyncio.sleep(fw.value)
+    return False
 
 
 # ---------------- Helper Functions ---------------- #
+_ADMIN_STATUSES = frozenset({ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER})
+
+
 async def is_admin_or_creator(client: Client, chat_id: int, user_id: int) -> bool:
-    """Checks if a user is an admin or creator in a chat."""
+    """Checks if a user is an admin or creator in a chat (cached for ADMIN_CACHE_TTL seconds)."""
+    key = (chat_id, user_id)
+    cached = _ADMIN_CACHE.get(key)
+    if cached is not None:
+        return cached
+
     try:
         member = await client.get_chat_member(chat_id, user_id)
-        return member.status in ("administrator", "creator")
+        is_admin = member.status in _ADMIN_STATUSES
     except Exception as e:
-        log.debug(f"Could not check admin status for {user_id} in {chat_id}: {e}")
+        log.debug("Could not check admin status for %s in %s: %s", user_id, chat_id, e)
         return False
 
+    _ADMIN_CACHE[key] = is_admin
+    return is_admin
+
+
+def set_cpu_affinity() -> None:
+    """Pins the process to CPU_AFFINITY (Linux only; no-op when unset)."""
+    if not CPU_AFFINITY:
+        return
+    if not hasattr(os, "sched_setaffinity"):
+        log.warning("⚠️ CPU_AFFINITY is set but not supported on this platform; ignoring it.")
+        return
+    try:
+        os.sched_setaffinity(0, CPU_AFFINITY)
+        log.info("📌 Pinned process to CPUs %s", sorted(CPU_AFFINITY))
+    except OSError as e:
+        log.warning("⚠️ Could not set CPU affinity %s: %s", sorted(CPU_AFFINITY), e)
+
+
+# Bot replies don't need to quote the command or preview links
+_REPLY_OPTS = {"quote": False, "disable_web_page_preview": True}
+
+_MENTION_TEMPLATE = "<a href='tg://user?id={}'>{}</a>"
+_FALLBACK_WELCOME_TEMPLATE = "Welcome {}! ✅"
+
+
+def mention_html(user) -> str:
+    """HTML tg://user mention for a user."""
+    return _MENTION_TEMPLATE.format(user.id, html.escape(user.first_name or str(user.id)))
+
 
-def build_start_keyboard(bot_username: Optional[str]) -> InlineKeyboardMarkup:
-    """Builds the keyboard for the /start message."""
+class CachedKeyboardMarkup(InlineKeyboardMarkup):
+    """
+    InlineKeyboardMarkup that converts itself to the raw TL object only once.
+    Only for constant url/callback keyboards (nothing that resolves peers).
+    """
+
+    async def write(self, client: Client):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raw = self._raw = await super().write(client)
+        return raw
+
+
+@functools.lru_cache(maxsize=1)
+def build_start_keyboard(bot_username: Optional[str]) -> CachedKeyboardMarkup:
+    """Builds the keyboard for the /start message (cached per bot username)."""
     add_group_link = f"https://t.me/{bot_username}?startgroup=true" if bot_username else "https://t.me/your_bot_here?startchannel=true"
-    return InlineKeyboardMarkup([
+    return CachedKeyboardMarkup([
         [
             InlineKeyboardButton("📣 Support Channel", url=CHANNEL_LINK),
             InlineKeyboardButton("➕ADD ME ", url=add_group_link)
@@ -128,88 +448,166 @@ WELCOME_TEXT = (
     "👉 Updates ke liye {mandatory_channel} join karein."
 )
 
-
-def get_welcome_keyboard(chat: Chat, bot_username: Optional[str]) -> InlineKeyboardMarkup:
-    """Builds the keyboard for the private welcome message."""
+# MANDATORY_CHANNEL is fixed after config load, so bake it in once and leave
+# only the per-user fields for the hot path. WELCOME_TEXT only uses **bold**,
+# so it is split on the markers once: odd-indexed parts are bold. Sending with
+# explicit entities skips Markdown parsing and keeps names from injecting markup.
+_WELCOME_PARTS = tuple(WELCOME_TEXT.replace("{mandatory_channel}", MANDATORY_CHANNEL).split("**"))
+
+
+def format_welcome(user_name: str, chat_title: Optional[str]) -> Tuple[str, List[MessageEntity]]:
+    """Renders WELCOME_TEXT for one approved user as (text, entities)."""
+    parts = [part.format(user_name=user_name, chat_title=chat_title) for part in _WELCOME_PARTS]
+    entities = []
+    offset = 0  # Telegram offsets count UTF-16 code units
+    for i, part in enumerate(parts):
+        length = len(part.encode("utf-16-le")) // 2
+        if i % 2 and length:
+            entities.append(MessageEntity(type=MessageEntityType.BOLD, offset=offset, length=length))
+        offset += length
+    return "".join(parts), entities
+
+
+@functools.lru_cache(maxsize=1)
+def get_welcome_keyboard(bot_username: Optional[str]) -> CachedKeyboardMarkup:
+    """Builds the keyboard for the private welcome message (cached per bot username)."""
     channel_btn = InlineKeyboardButton("📣 Main Channel", url=CHANNEL_LINK)
     add_group_link = f"https://t.me/{bot_username}?startgroup=true" if bot_username else f"https://t.me/your_bot_here?startgroup=true"
 
-    return InlineKeyboardMarkup([
+    return CachedKeyboardMarkup([
         [channel_btn, InlineKeyboardButton("➕ Bot Ko Group Mein Jorein", url=add_group_link)],
         [InlineKeyboardButton("📚 Rules", url=RULES_LINK), InlineKeyboardButton("🛠️ Support", url=SUPPORT_LINK)]
     ])
 
 
 # ---------------- Scheduled Background Cleaner Task ---------------- #
+_JOIN_REQUEST_CHAT_TYPES = frozenset({ChatType.CHANNEL, ChatType.SUPERGROUP})
+
+
+async def discover_join_request_chats(client: Client) -> Optional[Set[int]]:
+    """
+    Collects channel/supergroup ids from the bot's recent dialogs.
+    Returns None if the dialogs could not be fetched.
+    """
+    chats: Set[int] = set()
+    try:
+        # Fetch recent 500 dialogs to find potential target chats
+        async for dialog in client.get_dialogs(limit=500):
+            # NOTE: Only supergroup/channel types can have join requests
+            if dialog.chat.type in _JOIN_REQUEST_CHAT_TYPES:
+                chats.add(dialog.chat.id)
+        log.info("Found %s active chats/channels to check for old requests.", len(chats))
+        return chats
+    except RPCError as e:
+        # Handle errors during dialog fetching
+        if "CHAT_WRITE_FORBIDDEN" in str(e):
+            log.warning("⚠️ RPCError getting dialogs (Likely a forbidden chat/channel): %s. Skipping check and continuing.", e)
+        else:
+            log.error("❌ Critical RPCError getting dialogs for cleaner: %s", e)
+    except Exception as e:
+        log.error("❌ Unexpected error getting dialogs for cleaner: %s", e)
+    return None
+
+
+async def approve_pending_requests(client: Client, chat_id: int) -> List[object]:
+    """
+    Approves up to 50 old/missed join requests of a chat concurrently.
+    Returns one entry per request: 1 if approved, 0 if it still hit
+    FloodWait after FLOOD_WAIT_RETRIES attempts, or the exception raised.
+    """
+    user_ids = [req.user.id async for req in client.get_chat_join_requests(chat_id, limit=50)]
+    sem = asyncio.Semaphore(CLEANER_APPROVE_CONCURRENCY)
+    bucket = approve_bucket(chat_id)
+    approve_request = client.approve_chat_join_request
+
+    async def approve(uid: int) -> int:
+        async with sem:
+            if not await call_with_flood_retry(bucket, approve_request, chat_id, uid):
+                return 0
+            track_user(uid)
+            track_chat(chat_id)
+            return 1
+
+    return await asyncio.gather(*(approve(uid) for uid in user_ids), return_exceptions=True)
+
+
+async def clean_chat(client: Client, chat_id: int) -> int:
+    """Approves the pending requests of one chat and returns how many were approved."""
+    approved_count = 0
+    try:
+        results = await approve_pending_requests(client, chat_id)
+        approved_count = sum(r for r in results if isinstance(r, int))
+
+        _CHAT_ERROR_STRIKES.pop(chat_id, None)  # listing its requests worked
+        if approved_count > 0:
+            log.info("✅ Auto-cleaned %s pending requests in chat %s", approved_count, chat_id)
+
+        # Report the first failure through the handlers below
+        for r in results:
+            if isinstance(r, Exception):
+                raise r
+
+    except FloodWait as fw:
+        log.warning("⏳ FloodWait during cleaner for %s: sleeping %ss", chat_id, fw.value)
+        await asyncio.sleep(fw.value)
+    except (PeerIdInvalid, UserNotParticipant, ChatAdminRequired, ChannelPrivate) as e:
+        # <-- FIX: Added specific checks for Permission/Peer errors here
+        log.error("❌ PERMISSION ISSUE in chat %s: Bot lacks 'Manage Invite Links' permission or is not a member. Details: %s", chat_id, e)
+        # Stop checking it after a few cycles in a row (PeerIdInvalid can be transient
+        # right after a restart, since the in-memory session has no peers cached yet).
+        # A later approval there (instant or /approve) adds it back.
+        strikes = _CHAT_ERROR_STRIKES[chat_id] = _CHAT_ERROR_STRIKES.get(chat_id, 0) + 1
+        if strikes >= CHAT_DROP_STRIKES:
+            _CHAT_ERROR_STRIKES.pop(chat_id, None)
+            untrack_chat(chat_id)
+            log.warning("🗑️ Dropped chat %s from the cleaner after %s failed checks", chat_id, strikes)
+    except RPCError as e:
+        # Catch general RPC errors here
+        log.error("⚠️ RPCError while auto-cleaning %s: %s", chat_id, e)
+    except Exception as e:
+        log.error("❌ Unexpected error in auto-cleaner for %s: %s", chat_id, e)
+    return approved_count
+
+
 async def pending_requests_cleaner(client: Client):
     """
     Background task to check and clear already pending requests periodically (every 5 mins).
     This handles requests that arrived while the bot was offline or asleep.
     """
-    global BOT_USERNAME
-    
     # Wait for a short moment after startup to ensure everything is initialized
     await asyncio.sleep(15) 
 
+    if AUTO_APPROVE_CHAT_ID:
+        log.debug("Checking only the configured chat: %s", AUTO_APPROVE_CHAT_ID)
+
     while True:
         log.info("🧹 Starting scheduled check for already pending requests...")
-        
-        chats_to_check: Set[int] = set()
-        
+
         if AUTO_APPROVE_CHAT_ID:
-            # Check only the configured chat
-            chats_to_check.add(AUTO_APPROVE_CHAT_ID)
-            log.debug(f"Checking only the configured chat: {AUTO_APPROVE_CHAT_ID}")
+            chats_to_check = {AUTO_APPROVE_CHAT_ID}
         else:
-            # Check a limited number of recent chats (safer for high chat count)
-            try:
-                # Fetch recent 500 dialogs to find potential target chats
-                async for dialog in client.get_dialogs(limit=500):
-                    # NOTE: Only supergroup/channel types can have join requests
-                    if dialog.chat.type in ["channel", "supergroup"]:
-                        chats_to_check.add(dialog.chat.id)
-                log.info(f"Found {len(chats_to_check)} active chats/channels to check for old requests.")
-            except RPCError as e:
-                # Handle errors during dialog fetching
-                if "CHAT_WRITE_FORBIDDEN" in str(e):
-                    log.warning(f"⚠️ RPCError getting dialogs (Likely a forbidden chat/channel): {e}. Skipping check and continuing.")
-                else:
-                    log.error(f"❌ Critical RPCError getting dialogs for cleaner: {e}")
-            except Exception as e:
-                log.error(f"❌ Unexpected error getting dialogs for cleaner: {e}")
-
-
-        # Process pending requests for each identified chat
-        total_approved = 0
-        for chat_id in chats_to_check:
-            approved_count = 0
-            
-            try:
-                # Get and approve up to 50 pending requests per cycle per chat
-                # This call fetches old/missed requests!
-                async for req in client.get_chat_join_requests(chat_id, limit=50):
-                    await client.approve_chat_join_request(chat_id, req.user.id)
-                    USER_DATABASE.add(req.user.id)
-                    approved_count += 1
-                
-                if approved_count > 0:
-                    log.info(f"✅ Auto-cleaned {approved_count} pending requests in chat {chat_id}")
-                    total_approved += approved_count
-                    
-            except FloodWait as fw:
-                log.warning(f"⏳ FloodWait during cleaner for {chat_id}: sleeping {fw.value}s")
-                await asyncio.sleep(fw.value)
-            except (PeerIdInvalid, UserNotParticipant) as e:
-                # <-- FIX: Added specific checks for Permission/Peer errors here
-                log.error(f"❌ PERMISSION ISSUE in chat {chat_id}: Bot lacks 'Manage Invite Links' permission or is not a member. Details: {e}")
-            except RPCError as e:
-                # Catch general RPC errors here
-                log.error(f"⚠️ RPCError while auto-cleaning {chat_id}: {e}")
-            except Exception as e:
-                log.error(f"❌ Unexpected error in auto-cleaner for {chat_id}: {e}")
+            # Dialogs are scanned only to seed ADMIN_CHATS (first run without
+            # CHATS_FILE, or every chat dropped); after that, approvals keep the
+            # set up to date. Trade-off: once the set is non-empty, a new chat is
+            # only checked here after its first instant or manual approval, so
+            # requests sent there while the bot was offline wait until then.
+            if not ADMIN_CHATS:
+                discovered = await discover_join_request_chats(client)
+                for chat_id in discovered or ():
+                    track_chat(chat_id)
+            chats_to_check = set(ADMIN_CHATS)
+
+        # Process pending requests for all identified chats, a few at a time
+        sem = asyncio.Semaphore(CLEANER_CHAT_CONCURRENCY)
+
+        async def clean(chat_id: int) -> int:
+            async with sem:
+                return await clean_chat(client, chat_id)
+
+        total_approved = sum(await asyncio.gather(*(clean(chat_id) for chat_id in chats_to_check)))
 
         if total_approved > 0:
-            log.info(f"🎉 Scheduled check finished. Total approved: {total_approved}")
+            log.info("🎉 Scheduled check finished. Total approved: %s", total_approved)
         else:
             log.info("🧹 Scheduled check finished. No pending requests found.")
             
@@ -217,31 +615,55 @@ async def pending_requests_cleaner(client: Client):
         await asyncio.sleep(300)
 
 # ---------------- Startup Hook (Ensures Cleaner Starts Immediately) ---------------- #
-@app.on_message(filters.regex(".*", re.IGNORECASE) & filters.me)
-async def startup_cleaner_scheduler(client: Client, message: Message):
+_BOT_USERNAME_LOCK = asyncio.Lock()
+
+
+async def get_bot_username(client: Client) -> Optional[str]:
     """
-    Ensures global BOT_USERNAME is set and the background cleaner task starts only once.
+    Returns the cached BOT_USERNAME, fetching it with get_me() only while it
+    is still unknown. The lock makes concurrent callers share one fetch.
     """
     global BOT_USERNAME
-    
-    # 1. Set BOT_USERNAME once
-    if not BOT_USERNAME:
-        try:
-            me = await client.get_me()
-            BOT_USERNAME = me.username
-            log.info(f"Bot Username set to: @{BOT_USERNAME}")
-        except Exception:
-             pass 
-
-    # 2. Start the background task only once
-    if not client._cleaner_task_started:
-        log.info("Starting initial checks and GUARANTEED background pending requests cleaner task...")
-        asyncio.create_task(pending_requests_cleaner(client))
-        client._cleaner_task_started = True
-        log.info("Background pending cleaner task started successfully.")
-    
-    if message.command and message.command[0] in ["start", "status"]:
-        return
+    if BOT_USERNAME:
+        return BOT_USERNAME
+
+    async with _BOT_USERNAME_LOCK:
+        if not BOT_USERNAME:
+            try:
+                me = await client.get_me()
+                BOT_USERNAME = me.username
+                log.info("Bot Username set to: @%s", BOT_USERNAME)
+            except Exception as e:
+                log.warning("Could not fetch bot username: %s", e)
+    return BOT_USERNAME
+
+
+async def on_startup(client: Client):
+    """
+    Runs once right after the client connects: caches BOT_USERNAME and starts
+    the background cleaner task.
+    """
+    global CLEANER_TASK, _FLUSH_TASK
+
+    _FLUSH_TASK = asyncio.create_task(users_flusher())
+
+    # Warm the username and keyboard caches so the first /start and approval reuse them
+    bot_username = await get_bot_username(client)
+    build_start_keyboard(bot_username)
+    get_welcome_keyboard(bot_username)
+
+    for _ in range(JOIN_REQUEST_WORKERS):
+        _JOIN_WORKER_TASKS.append(asyncio.create_task(join_request_worker(client)))
+    for _ in range(WELCOME_WORKERS):
+        _WELCOME_WORKER_TASKS.append(asyncio.create_task(welcome_worker(client)))
+
+    log.info("Starting background pending requests cleaner task...")
+    CLEANER_TASK = asyncio.create_task(pending_requests_cleaner(client))
+    log.info("Background pending cleaner task started successfully.")
+
+
+def cleaner_active() -> bool:
+    return CLEANER_TASK is not None and not CLEANER_TASK.done()
 
 
 # ---------------- Handlers (Unchanged for Functionality) ---------------- #
@@ -251,83 +673,174 @@ async def start_handler(client: Client, message: Message):
     if not user:
         return
 
-    USER_DATABASE.add(user.id)
-    log.info(f"🆕 /start from {user.id} — added to USER_DATABASE (count={len(USER_DATABASE)})")
+    track_user(user.id)
+    BLOCKED_USERS.discard(user.id)  # they are talking to the bot, so PMs work again
+    log.debug("🆕 /start from %s — added to USER_DATABASE (count=%s)", user.id, len(USER_DATABASE))
 
     try:
-        me = await client.get_me()
-        bot_username_local = me.username or None
         await message.reply_text(
             START_MESSAGE.format(user_name=user.first_name or "User"),
-            reply_markup=build_start_keyboard(bot_username_local),
-            disable_web_page_preview=True
+            reply_markup=build_start_keyboard(await get_bot_username(client)),
+            **_REPLY_OPTS
         )
     except Exception as e:
-        log.warning(f"Failed to respond to /start for {user.id}: {e}")
+        log.warning("Failed to respond to /start for %s: %s", user.id, e)
+
+
+# Exact-match filter. It's async on purpose: Pyrogram runs sync filter
+# functions in its thread-pool executor.
+async def _is_status_check(_, __, query) -> bool:
+    return query.data == "status_check"
+
+
+STATUS_CHECK_FILTER = filters.create(_is_status_check)
 
 
-@app.on_callback_query(filters.regex(r"^status_check$"))
+@app.on_callback_query(STATUS_CHECK_FILTER)
 async def status_checker(client: Client, callback_query):
     await callback_query.answer(
-        f"🚀 Bot Active | Total Users Tracked: {len(USER_DATABASE)} | Cleaner Active: {app._cleaner_task_started}",
+        f"🚀 Bot Active | Total Users Tracked: {len(USER_DATABASE)} | Cleaner Active: {cleaner_active()}",
         show_alert=True
     )
 
 # ----------------------------------------------
 ## Auto-Approve Join Requests (Universal & Instant)
 # ----------------------------------------------
-@app.on_chat_join_request()
-async def auto_approve(client: Client, req: ChatJoinRequest):
-    user = req.from_user
-    chat = req.chat
+# When AUTO_APPROVE_CHAT_ID is set, other chats are filtered out by Pyrogram
+# before the handler is scheduled.
+JOIN_REQUEST_FILTER = filters.chat(AUTO_APPROVE_CHAT_ID) if AUTO_APPROVE_CHAT_ID else filters.all
 
-    if AUTO_APPROVE_CHAT_ID and chat.id != AUTO_APPROVE_CHAT_ID:
-        log.debug(f"Ignoring join request from chat {chat.id} because AUTO_APPROVE_CHAT_ID is set and doesn't match.")
+
+@app.on_chat_join_request(JOIN_REQUEST_FILTER)
+async def auto_approve(client: Client, req: ChatJoinRequest):
+    user_id = req.from_user.id
+    chat_id = req.chat.id
+
+    # Repeat updates for the same request within DUPLICATE_REQUEST_WINDOW are
+    # dropped. Nothing is awaited between the check and the store, so no other
+    # handler can interleave here.
+    request_key = (chat_id, user_id)
+    now = time.monotonic_ns()
+    started = PENDING_REQUESTS.get(request_key)
+    if started is not None and now - started < _DUPLICATE_REQUEST_WINDOW_NS:
+        log.debug("Skipping duplicate join request: user=%s chat=%s", user_id, chat_id)
         return
+    PENDING_REQUESTS[request_key] = now
+
+    # Hand off to the join-request workers so this dispatcher slot is freed
+    # immediately; put() only waits when the queue is full.
+    await _JOIN_QUEUE.put(req)
+
+
+async def join_request_worker(client: Client):
+    """
+    Drains _JOIN_QUEUE in micro-batches: takes one request, grabs whatever
+    else is already queued (up to JOIN_BATCH_SIZE) and processes the batch
+    concurrently. No extra wait is added, so a lone request is still instant.
+    """
+    while True:
+        batch = [await _JOIN_QUEUE.get()]
+        while len(batch) < JOIN_BATCH_SIZE:
+            try:
+                batch.append(_JOIN_QUEUE.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        await asyncio.gather(*(process_join_request(client, req) for req in batch), return_exceptions=True)
 
-    log.info(f"➡️ Processing INSTANT join request: user={user.id} chat={chat.id}")
-    request_key = (chat.id, user.id)
-    PENDING_REQUESTS[request_key] = time.time()
 
-    USER_DATABASE.add(user.id)
+async def process_join_request(client: Client, req: ChatJoinRequest):
+    """Approves one join request and sends the welcome PM (or chat fallback)."""
+    user = req.from_user
+    chat = req.chat
+    user_id = user.id
+    chat_id = chat.id
+    request_key = (chat_id, user_id)
+
+    log.debug("➡️ Processing INSTANT join request: user=%s chat=%s", user_id, chat_id)
+    track_user(user_id)
 
     try:
-        await req.approve()
+        if not await call_with_flood_retry(approve_bucket(chat_id), req.approve):
+            log.warning("⏳ Still FloodWait after %s attempts; leaving %s in %s to the cleaner", FLOOD_WAIT_RETRIES, user_id, chat_id)
+            return
         PENDING_REQUESTS.pop(request_key, None)
-        log.info(f"✅ Approved INSTANT join request: {user.id} -> {chat.title}")
+        track_chat(chat_id)
+        log.info("✅ Approved INSTANT join request: %s -> %s", user_id, chat.title)
     except RPCError as e:
-        log.error(f"❌ RPCError while approving {user.id} for chat {chat.id}: {e} (Check 'Manage Invite Links' permission)")
+        log.error("❌ RPCError while approving %s for chat %s: %s (Check 'Manage Invite Links' permission)", user_id, chat_id, e)
         return
     except Exception as e:
-        log.error(f"❌ Unexpected error while approving join request: {e}")
+        log.error("❌ Unexpected error while approving join request: %s", e)
+        return
+
+    if request_key in _WELCOMED:
+        log.debug("Already welcomed %s in %s recently; skipping PM", user_id, chat_id)
+        return
+
+    # The welcome doesn't affect the approval, so hand it to the welcome workers
+    try:
+        _WELCOME_QUEUE.put_nowait((user, chat))
+    except asyncio.QueueFull:
+        log.warning("⚠️ Welcome queue full; skipping PM to %s", user_id)
         return
+    # Marked only once queued, so a dropped PM doesn't block the next one
+    _WELCOMED[request_key] = True
+
+
+async def welcome_worker(client: Client):
+    """Sends queued welcome PMs; MESSAGE_BUCKET paces all workers together."""
+    while True:
+        user, chat = await _WELCOME_QUEUE.get()
+        await send_welcome(client, user, chat)
+
+
+async def send_welcome(client: Client, user: User, chat: Chat):
+    """Sends the private welcome message, falling back to a mention in the chat."""
+    user_id = user.id
+    chat_id = chat.id
+    # Built once and reused by every FloodWait retry
+    text, entities = format_welcome(user.first_name or "Friend", chat.title or "this chat")
+    keyboard = get_welcome_keyboard(await get_bot_username(client))
+    if user_id in BLOCKED_USERS:
+        log.debug("Skipping welcome PM to %s: known to be unreachable", user_id)
+    else:
+        for attempt in range(1, FLOOD_WAIT_RETRIES + 1):
+            try:
+                async with MESSAGE_BUCKET:
+                    await client.send_message(user_id, text, entities=entities, reply_markup=keyboard)
+                log.debug("✉️ Sent welcome PM to %s", user_id)
+            except FloodWait as fw:
+                if attempt == FLOOD_WAIT_RETRIES:
+                    log.warning("⏳ Still FloodWait after %s attempts; dropped welcome PM to %s", attempt, user_id)
+                    return
+                log.warning("⏳ FloodWait while sending welcome PM to %s: sleeping %ss", user_id, fw.value)
+                await asyncio.sleep(fw.value)
+                continue
+            except (PeerIdInvalid, UserIsBlocked, UserNotParticipant):
+                BLOCKED_USERS.add(user_id)
+                break
+            except Exception as e:
+                log.warning("⚠️ Failed to send PM to %s: %s", user_id, e)
+            return
 
-    # Try sending private welcome message
+    log.info("⚠️ Could not PM user %s — sending a fallback message to the chat.", user_id)
     try:
-        me = await client.get_me()
-        bot_username_local = me.username or BOT_USERNAME or None
-        await client.send_message(
-            user.id,
-            WELCOME_TEXT.format(user_name=user.first_name or "Friend", chat_title=chat.title or "this chat", mandatory_channel=MANDATORY_CHANNEL),
-            reply_markup=get_welcome_keyboard(chat, bot_username_local)
+        sent = await call_with_flood_retry(
+            MESSAGE_BUCKET, client.send_message, chat_id,
+            _FALLBACK_WELCOME_TEMPLATE.format(mention_html(user)), parse_mode=ParseMode.HTML
         )
-        log.info(f"✉️ Sent welcome PM to {user.id}")
-    except (PeerIdInvalid, UserIsBlocked, UserNotParticipant):
-        log.info(f"⚠️ Could not PM user {user.id} — sending a fallback message to the chat.")
-        try:
-            mention = user.mention if hasattr(user, "mention") else f"<a href='tg://user?id={user.id}'>{user.first_name}</a>"
-            await client.send_message(chat.id, f"Welcome {mention}! ✅", parse_mode="html")
-        except Exception as e:
-            log.debug(f"Failed to send fallback chat message in {chat.id}: {e}")
+        if not sent:
+            log.warning("⏳ Still FloodWait; dropped fallback welcome for %s in %s", user_id, chat_id)
     except Exception as e:
-        log.warning(f"⚠️ Failed to send PM to {user.id}: {e}")
+        log.debug("Failed to send fallback chat message in %s: %s", chat_id, e)
 
 
 # ---------------- Manual approve command (admins only) ---------------- #
 @app.on_message(filters.command("approve") & filters.group)
 async def manual_approve_handler(client: Client, message: Message):
-    if not await is_admin_or_creator(client, message.chat.id, message.from_user.id):
-        await message.reply_text("⛔ Yeh command sirf admins ke liye hai.")
+    chat_id = message.chat.id
+    if not await is_admin_or_creator(client, chat_id, message.from_user.id):
+        await message.reply_text("⛔ Yeh command sirf admins ke liye hai.", **_REPLY_OPTS)
         return
 
     target_user_id = None
@@ -336,94 +849,181 @@ async def manual_approve_handler(client: Client, message: Message):
     elif len(message.command) > 1 and message.command[1].lstrip("-").isdigit():
         target_user_id = int(message.command[1])
     else:
-        await message.reply_text("❓ Reply karein user ko ya `/approve <user_id>` dein.")
+        await message.reply_text("❓ Reply karein user ko ya `/approve <user_id>` dein.", **_REPLY_OPTS)
+        return
+
+    try:
+        if not await call_with_flood_retry(approve_bucket(chat_id), client.approve_chat_join_request, chat_id, target_user_id):
+            await message.reply_text("⏳ Telegram abhi rate-limit kar raha hai, thodi der baad try karein.", **_REPLY_OPTS)
+            return
+    except RPCError as e:
+        await message.reply_text(f"❌ Approval failed (RPCError): {e}", **_REPLY_OPTS)
+        return
+    except Exception as e:
+        await message.reply_text(f"❌ Approval failed: {e}", **_REPLY_OPTS)
         return
 
+    # The approval went through; nothing below may report it as failed
+    PENDING_REQUESTS.pop((chat_id, target_user_id), None)
+    track_chat(chat_id)
+    track_user(target_user_id)
+
+    first_name = None
     try:
-        await client.approve_chat_join_request(message.chat.id, target_user_id)
-        PENDING_REQUESTS.pop((message.chat.id, target_user_id), None)
         approved_user = await client.get_users(target_user_id)
-        await message.reply_text(f"✅ {approved_user.first_name} ({approved_user.id}) ko approve kar diya gaya.")
-        USER_DATABASE.add(target_user_id)
+        first_name = approved_user.first_name
+    except FloodWait as fw:
+        log.warning("⏳ FloodWait on get_users(%s) after manual approval: %ss", target_user_id, fw.value)
+    except Exception as e:
+        log.debug("Could not fetch user %s after manual approval: %s", target_user_id, e)
+
+    try:
+        await message.reply_text(f"✅ {first_name or 'User'} ({target_user_id}) ko approve kar diya gaya.", **_REPLY_OPTS)
+    except FloodWait as fw:
+        log.warning("⏳ FloodWait on /approve reply in %s: %ss", chat_id, fw.value)
+    except Exception as e:
+        log.debug("Could not reply to /approve in %s: %s", chat_id, e)
 
+    if target_user_id not in BLOCKED_USERS:
         try:
-            me = await client.get_me()
-            bot_username_local = me.username or BOT_USERNAME or None
-            await client.send_message(
-                target_user_id,
-                WELCOME_TEXT.format(user_name=approved_user.first_name or "Friend", chat_title=message.chat.title, mandatory_channel=MANDATORY_CHANNEL),
-                reply_markup=get_welcome_keyboard(message.chat, bot_username_local)
-            )
+            text, entities = format_welcome(first_name or "Friend", message.chat.title)
+            keyboard = get_welcome_keyboard(await get_bot_username(client))
+            async with MESSAGE_BUCKET:
+                await client.send_message(target_user_id, text, entities=entities, reply_markup=keyboard)
+        except (PeerIdInvalid, UserIsBlocked, UserNotParticipant) as e:
+            BLOCKED_USERS.add(target_user_id)
+            log.debug("Could not send PM after manual approval to %s: %s", target_user_id, e)
         except Exception as e:
-            log.debug(f"Could not send PM after manual approval to {target_user_id}: {e}")
-
-    except RPCError as e:
-        await message.reply_text(f"❌ Approval failed (RPCError): {e}")
-    except Exception as e:
-        await message.reply_text(f"❌ Approval failed: {e}")
+            log.debug("Could not send PM after manual approval to %s: %s", target_user_id, e)
 
 
 # ---------------- Broadcast (developer only) ---------------- #
+# Permanent per-user errors; only these prune a user from USERS_FILE
+_DEAD_USER_ERRORS = (UserIsBlocked, InputUserDeactivated, PeerIdInvalid, UserNotParticipant)
+
 @app.on_message(filters.command("broadcast") & filters.private)
 async def broadcast_handler(client: Client, message: Message):
     if not DEVELOPER_ID:
-        await message.reply_text("⚠️ Broadcasting is disabled on this bot (DEVELOPER_ID not configured).")
+        await message.reply_text("⚠️ Broadcasting is disabled on this bot (DEVELOPER_ID not configured).", **_REPLY_OPTS)
         return
 
     if message.from_user.id != DEVELOPER_ID:
-        await message.reply_text("⛔ Yeh command sirf developer ke liye hai.")
+        await message.reply_text("⛔ Yeh command sirf developer ke liye hai.", **_REPLY_OPTS)
         return
 
     if not message.reply_to_message:
-        await message.reply_text("❓ Reply karein us message ko jise aap broadcast karna chahte hain.")
+        await message.reply_text("❓ Reply karein us message ko jise aap broadcast karna chahte hain.", **_REPLY_OPTS)
         return
 
     broadcast_message = message.reply_to_message
+    copy = broadcast_message.copy
     total = len(USER_DATABASE)
-    await message.reply_text(f"🚀 Broadcast shuru ho raha hai — {total} users ko bheja jayega.")
+    status_msg = await message.reply_text(f"🚀 Broadcast shuru ho raha hai — {total} users ko bheja jayega.", **_REPLY_OPTS)
+
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def send_one(uid: int, dead: array.array) -> bool:
+        async with sem:
+            for attempt in range(1, FLOOD_WAIT_RETRIES + 1):
+                try:
+                    async with MESSAGE_BUCKET:
+                        await copy(uid)
+                    return True
+                except FloodWait as fw:
+                    if attempt == FLOOD_WAIT_RETRIES:
+                        break  # no retry follows, so don't hold the semaphore slot sleeping
+                    log.warning("⏳ FloodWait during broadcast: sleeping %ss", fw.value)
+                    await asyncio.sleep(fw.value)
+                except _DEAD_USER_ERRORS:
+                    dead.append(uid)
+                    return False
+                except RPCError as e:
+                    # Transient or not about this user (5xx, deleted source message, ...):
+                    # count it as failed but keep the user
+                    log.warning("⚠️ RPCError broadcasting to %s: %s", uid, e)
+                    return False
+                except Exception as e:
+                    log.error("Error broadcasting to %s: %s", uid, e)
+                    return False
+            return False
 
     sent = 0
     failed = 0
-    for uid in list(USER_DATABASE):
-        try:
-            await broadcast_message.copy(uid)
-            sent += 1
-            await asyncio.sleep(0.05)
-        except FloodWait as fw:
-            log.warning(f"⏳ FloodWait during broadcast: sleeping {fw.value}s")
-            await asyncio.sleep(fw.value)
+    # Unreachable users are collected here and pruned once after the broadcast
+    dead = array.array("q")
+    # Packed int64 snapshot: 8 bytes per user instead of a list of int objects
+    snapshot = array.array("q", USER_DATABASE)
+    last_edit = time.monotonic()
+    for i in range(0, len(snapshot), BROADCAST_CHUNK):
+        results = await asyncio.gather(*(send_one(uid, dead) for uid in snapshot[i:i + BROADCAST_CHUNK]))
+        delivered = sum(results)
+        sent += delivered
+        failed += len(results) - delivered
+
+        # One status edit per chunk at most, and no more often than BROADCAST_PROGRESS_INTERVAL
+        now = time.monotonic()
+        if now - last_edit >= BROADCAST_PROGRESS_INTERVAL:
+            last_edit = now
             try:
-                await broadcast_message.copy(uid)
-                sent += 1
-            except Exception:
-                failed += 1
-        except (UserIsBlocked, UserNotParticipant, PeerIdInvalid, RPCError) as e:
-            USER_DATABASE.discard(uid)
-            failed += 1
-        except Exception as e:
-            log.error(f"Error broadcasting to {uid}: {e}")
-            failed += 1
+                await status_msg.edit_text(f"📤 Broadcast chal raha hai... Sent: {sent}/{total}, Failed: {failed}")
+            except Exception as e:
+                log.debug("Could not update broadcast progress: %s", e)
+
+    if dead:
+        USER_DATABASE.difference_update(dead)
+        save_users()
 
-    await message.reply_text(f"✅ Broadcast complete. Sent: {sent}, Failed/Removed: {failed}, Current tracked: {len(USER_DATABASE)}")
+    await message.reply_text(f"✅ Broadcast complete. Sent: {sent}, Failed/Removed: {failed}, Current tracked: {len(USER_DATABASE)}", **_REPLY_OPTS)
 
 
 # ---------------- Run ---------------- #
-def run_fastapi():
-    """FastAPI health check server ko separate thread mein chalaata hai."""
-    uvicorn.run(web_app, host="0.0.0.0", port=WEB_PORT, log_level="info")
+async def main():
+    """Runs the Pyrogram client and the FastAPI health check on one event loop."""
+    import uvicorn  # only needed once the server actually starts
+
+    server = uvicorn.Server(uvicorn.Config(web_app, host="0.0.0.0", port=WEB_PORT, log_level="info", access_log=False))
+
+    log.info("🔁 Event loop: %s", type(asyncio.get_running_loop()).__module__)
+
+    # Loaded before the client starts, so updates dispatched during start()
+    # already see the known ids and don't re-append them to the files
+    USER_DATABASE.update(load_ids(USERS_FILE))
+    ADMIN_CHATS.update(load_ids(CHATS_FILE))
+    log.info("📂 Loaded %s users from %s and %s chats from %s", len(USER_DATABASE), USERS_FILE, len(ADMIN_CHATS), CHATS_FILE)
+
+    await app.start()
+    # From now on every FloodWait is raised instead of slept through inside
+    # invoke(), so the TokenBuckets see it and back off; call sites retry
+    app.sleep_threshold = 0
+    await on_startup(app)
+    try:
+        # Blocks until uvicorn receives SIGINT/SIGTERM; web_lifespan runs
+        # shutdown() before that signal is re-raised
+        await server.serve()
+    finally:
+        # Covers serve() failing before the lifespan ran (e.g. bad config)
+        await shutdown()
+
+
+async def shutdown():
+    """Stops the client and writes out buffered users/chats and log records. Idempotent."""
+    try:
+        if app.is_connected:
+            log.info("⌛ Shutting down — stopping client and saving users/chats")
+            await app.stop()
+    finally:
+        flush_users()
+        drain_logs()
 
 
 if __name__ == "__main__":
     log.info("🚀 Starting Bot — FastAPI healthcheck + Pyrogram bot")
+    set_cpu_affinity()
 
-    # Start health check server in background thread
-    threading.Thread(target=run_fastapi, daemon=True).start()
-
-    # Run pyrogram (blocks)
     try:
         log.info("Client is starting now...")
-        app.run()
+        app.run(main())
     except KeyboardInterrupt:
         log.info("⌛ Shutting down (KeyboardInterrupt)")
     except Exception as e:
-        log.error(f"🔥 Fatal error running pyrogram client: {e}")
+        log.error("🔥 Fatal error running pyrogram client: %s", e)